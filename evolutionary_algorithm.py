@@ -2,198 +2,288 @@
 #
 # Experiment Setup
 # -------------------------------
-# Representation: Route = List of integers associated with cities e.g. [0,1,2,3,4,5]
-# Fitness Evaluation: get_cost_of_route() function which adds up the distances between all cities in a route
+# Representation: Route = NumPy array of integers associated with cities e.g. [0,1,2,3,4,5]
+# Fitness Evaluation: get_cost_of_route() function which adds up the distances between all cities in a route, looked up from a precomputed distance matrix
 # Recombination: Order 1 Crossover function which takes a random section of one route and inserts it into another route while keeping all elements unique
 # Recombination Probability: 100% (Required)
-# Mutation: two_op_swap() function will randomly swap two cities in a route
+# Mutation: two_opt_swap_population() function will randomly swap two cities in each selected route of the offspring
 # Mutation Probability: Test: 20%, Actual: 50%
-# Parent Selection: Tournament Selection, Selection of parents chosen at random and best parent returned
+# Parent Selection: Tournament Selection, Selection of parents chosen at random (with replacement) and best parent returned
 # Survivor Selection: Elitism Model, Offspring added to parent population, then culled based on fitness back to {population size}
 # Selection Size: TEst = 10, Actual = 30
 # Population Size: Test = 100, Actual = 200
 # Initialisation: Create a list of length {population size} containing randomly generated routes. Repetitions are allowed.
 # Termination: After 42 generations tested
+# Islands: Optionally split the population into {island count} islands evolved in separate processes, best routes migrate between islands every {migration interval} generations
 #
 
-import math
-import random
 import time
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from numba import njit, prange, set_num_threads
+
+# Distances are stored as float32 to keep the distance matrix cache resident,
+# city indices as int32 so the fitness gather can use native 32-bit indices
+ROUTE_DTYPE = np.int32
+DISTANCE_DTYPE = np.float32
+
+rng = np.random.default_rng()
 
 def get_cities_from_file(file_name):
-    csv_file = open(file_name, "r")
-    cities_map = []
-    for line in csv_file:
-        city = []
-        for coord in line.split(","):
-            coord = coord.rstrip()
-            city += [float(coord)]
-        cities_map += [city]
+    return np.loadtxt(file_name, delimiter=",", dtype=np.float64, ndmin=2)
 
-    return cities_map
+def get_distance_matrix(cities_map):
+    coords = np.asarray(cities_map, dtype=np.float64)
+    diff = coords[:, None, :] - coords[None, :, :]
+    return np.ascontiguousarray(np.sqrt((diff * diff).sum(-1)), dtype=DISTANCE_DTYPE)
 
 def get_list_of_cities(cities_map):
     return list(range(len(cities_map)))
 
-def get_cost_of_route(route, cities_map):
-    total = 0
-    i = 0
-
-    while i < len(route)-1:
-        total += get_cost_between_cities(cities_map, route[i],route[i+1])
-        i += 1
-    total += get_cost_between_cities(cities_map, route[-1], route[0])
+@njit(fastmath=True, cache=True)
+def get_cost_of_route(route, distance_matrix, city_count):
+    total = 0.0
+    for i in range(city_count - 1):
+        total += distance_matrix[route[i], route[i + 1]]
+    total += distance_matrix[route[city_count - 1], route[0]]
 
     return total
 
-def get_cost_between_cities(cities_map, city_1, city_2):
-
-    return distance_between_coords(cities_map[city_1][0],
-                                   cities_map[city_2][0],
-                                   cities_map[city_1][1],
-                                   cities_map[city_2][1])
-
-def distance_between_coords(x1, x2, y1, y2):
-    return math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-
-def generate_random_route(city_list):
-    copy = city_list[1:]
-    random.shuffle(copy)
-    city_list[1:] = copy
-    return city_list
-
-def two_opt_swap(route):
-    random_cities = random.sample(range(0,len(route)), 2)
-
-    new_route = route.copy()
-
-    new_route[random_cities[0]] = route[random_cities[1]]
-    new_route[random_cities[1]] = route[random_cities[0]]
-    return new_route
-
-def order_one_crossover(route1, route2):
-    first = random.randint(0, len(route1) - 1)
-    last = random.randint(first + 1, len(route1))
-
-    new_route = route1[first:last]
+def get_cost_between_cities(distance_matrix, city_1, city_2):
+    return distance_matrix[city_1, city_2]
+
+def generate_random_route(city_count):
+    return rng.permutation(city_count).astype(ROUTE_DTYPE)
+
+def two_opt_swap_population(population, mutation_probability):
+    city_count = population.shape[1]
+    rows = np.flatnonzero(rng.random(len(population)) <= mutation_probability)
+    first = rng.integers(0, city_count, len(rows))
+    second = (first + rng.integers(1, city_count, len(rows))) % city_count
+
+    first_cities = population[rows, first]
+    population[rows, first] = population[rows, second]
+    population[rows, second] = first_cities
+
+@njit(cache=True)
+def order_one_crossover(route1, route2, first, last, new_route):
+    placed = np.zeros(len(route1), np.bool_)
+    length = last - first
+    new_route[:length] = route1[first:last]
+    for city in new_route[:length]:
+        placed[city] = True
     for city in route2:
-        if city not in new_route:
-            new_route.append(city)
-    return new_route
-
-def tournament_select_route(cities_map, parents, selection_size):
-    selection = random.sample(parents,selection_size)
-    shortest_route = selection[0]
-    cost = get_cost_of_route(selection[0], cities_map)
-    for route in selection:
-        new_cost = get_cost_of_route(route, cities_map)
-        if cost > new_cost:
-            cost = new_cost
-            shortest_route = route
-    return shortest_route
-
-def tournament_selection(cities_map, parents, selection_size, population_size):
-    population = []
-    while len(population) < population_size:
-        if random.random() < 1:
-            population.append(tournament_select_route(cities_map, parents, selection_size))
-        else:
-            population.append(generate_random_route(city_list))
-    return population
+        if not placed[city]:
+            new_route[length] = city
+            placed[city] = True
+            length += 1
+
+@njit(parallel=True, cache=True)
+def order_one_crossover_population(parents, first_parents, second_parents, firsts, lasts):
+    offspring = np.empty((len(first_parents), parents.shape[1]), parents.dtype)
+    for i in prange(len(first_parents)):
+        order_one_crossover(parents[first_parents[i]], parents[second_parents[i]], firsts[i], lasts[i], offspring[i])
+    return offspring
+
+def sample_crossovers(parent_count, city_count, crossover_count):
+    first_parents = rng.integers(0, parent_count, crossover_count)
+    second_parents = rng.integers(0, parent_count, crossover_count)
+    firsts = rng.integers(0, city_count, crossover_count)
+    lasts = rng.integers(firsts + 1, city_count + 1)
+    return first_parents, second_parents, firsts, lasts
+
+def tournament_selection(population, costs, selection_size, population_size):
+    # Draw every tournament of the generation at once, one row of contestants per selected parent
+    contestants = rng.integers(0, len(costs), (population_size, selection_size))
+    selected = contestants[np.arange(population_size), costs[contestants].argmin(axis=1)]
+    return population[selected], costs[selected]
 
 def initialise_population(cities_list, population_size):
     population = []
+    seen_routes = set()
     while len(population) < population_size:
-        new_route = generate_random_route(cities_list)
-        if new_route not in population:
-            population.append(new_route[:])
-    return population
-
-def find_shortest_route_in_population(population, cities_map):
-    shortest_route = population[0]
-    cost = get_cost_of_route(population[0], cities_map)
-    for route in population:
-        new_cost = get_cost_of_route(route, cities_map)
-        if cost > new_cost:
-            cost = new_cost
-            shortest_route = route
-    return shortest_route
+        new_route = generate_random_route(len(cities_list))
+        if new_route.tobytes() not in seen_routes:
+            seen_routes.add(new_route.tobytes())
+            population.append(new_route)
+    return np.stack(population)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def evaluate_population(population, distance_matrix):
+    costs = np.empty(population.shape[0], np.float64)
+    for i in prange(population.shape[0]):
+        costs[i] = get_cost_of_route(population[i], distance_matrix, population.shape[1])
+    return costs
+
+def make_population_evaluator(city_count):
+    # Specialise evaluate_population for a fixed number of cities, the constant loop bound lets LLVM unroll the edge sum
+    @njit(parallel=True, fastmath=True, cache=True)
+    def evaluate_fixed_size_population(population, distance_matrix):
+        costs = np.empty(population.shape[0], np.float64)
+        for i in prange(population.shape[0]):
+            costs[i] = get_cost_of_route(population[i], distance_matrix, city_count)
+        return costs
+
+    def population_evaluator(population, distance_matrix):
+        if population.shape[1] != city_count:
+            raise ValueError(f"Expected routes of {city_count} cities, got {population.shape[1]}")
+        return evaluate_fixed_size_population(population, distance_matrix)
+    return population_evaluator
+
+def find_shortest_route_in_population(population, costs):
+    shortest = costs.argmin()
+    return population[shortest], costs[shortest]
+
+def evolve_generation(distance_matrix, population, population_costs, population_size, selection_size, mutation_probability, recombination_probability, population_evaluator=evaluate_population):
+    # Select the best parents in the population using Tournament Select
+    parents, parent_costs = tournament_selection(population, population_costs, selection_size, population_size)
+
+    # Generate 3 x (number of parents) Offspring, sampling the parents and segment of every crossover up front
+    crossover_count = np.count_nonzero(rng.random(len(parents) * 3) <= recombination_probability)
+    crossovers = sample_crossovers(len(parents), population.shape[1], crossover_count)
+    offspring = order_one_crossover_population(parents, *crossovers)
+
+    # Mutate Offspring
+    two_opt_swap_population(offspring, mutation_probability)
+
+    # Create new population from parents and offspring
+    # Only offspring need evaluating, parents carry their cost over from the previous generation
+    new_population = np.concatenate((parents, offspring))
+    costs = np.concatenate((parent_costs, population_evaluator(offspring, distance_matrix)))
+
+    # Elitism, pick only the best of all routes from the population without sorting the rest
+    keep = np.argpartition(costs, population_size - 1)[:population_size]
+
+    # Order the survivors by cost of route, lower costs first
+    keep = keep[np.argsort(costs[keep])]
+
+    return new_population[keep], costs[keep]
+
+def report_generation(generation, new_route, new_cost, shortest_route, shortest_cost):
+    if new_cost < shortest_cost:
+        print(f"Gen {generation}: {new_cost:.14f} - {new_route}             === NEW BEST ===")
+        return new_route.copy(), new_cost
+    print(f"Gen {generation}: {new_cost:.14f} - {new_route}           [{shortest_cost:.14f}]")
+    return shortest_route, shortest_cost
+
+def report_shortest_route(shortest_route, shortest_cost):
+    print(f"\n=============== FINISHED ===============\nShortest Size: {shortest_cost}\nShortest Route: {shortest_route}")
 
-def evolution(cities_map, city_list, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability):
-    shortest_route = city_list
-    shortest_cost = get_cost_of_route(city_list, cities_map)
+def evolution(distance_matrix, city_list, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability, population_evaluator=evaluate_population):
     generation = 1
 
     # Initialise the population randomly
     population = initialise_population(city_list, population_size)
+    population_costs = population_evaluator(population, distance_matrix)
+    shortest_route, shortest_cost = find_shortest_route_in_population(population, population_costs)
 
     # Run for specified number of generations
     while generation <= termination_max_generations:
 
-        # Select the best parents in the population using Tournament Select
-        parents = tournament_selection(cities_map, population, selection_size, population_size)
-
-        # Generate 3 x (number of parents) Offspring
-        offspring = []
-        i = 0
-        while i < len(parents) * 3:
-            if random.random() <= recombination_probability:
-                parent = random.choice(parents)
-                other_parent = random.choice(parents)
-                offspring.append(order_one_crossover(parent, other_parent))
-            i += 1
-
-        # Mutate Offspring
-        i = 0
-        for i in range(len(offspring)):
-            if random.random() <= mutation_probability:
-                offspring[i] = two_opt_swap(offspring[i])
-                i += 1
-
-        # Create new population from parents and offspring
-        new_population = parents + offspring
-
-        # Sort the population based on cost of route, lower costs first
-        new_population.sort(key = lambda route: get_cost_of_route(route, cities_map))
-        
-        # Elitism, pick only the best of all routes from the population
-        new_population = new_population[:population_size]
+        # Replace the old population with the newly generated one
+        population, population_costs = evolve_generation(distance_matrix, population, population_costs, population_size, selection_size, mutation_probability, recombination_probability, population_evaluator)
 
         # Evaluate best from this generation
-        new_route = new_population[0]
-        new_cost = get_cost_of_route(new_population[0], cities_map)
-
-        # Replace the old population with the newly generated one
-        population = new_population
-
-        if new_cost < shortest_cost:
-            shortest_cost = new_cost
-            shortest_route = new_route
-            print(f"Gen {generation}: {shortest_cost:.14f} - {shortest_route}             === NEW BEST ===")
-        else:
-            print(f"Gen {generation}: {new_cost:.14f} - {new_route}           [{shortest_cost:.14f}]")
+        shortest_route, shortest_cost = report_generation(generation, population[0], population_costs[0], shortest_route, shortest_cost)
         generation += 1
 
     # Return Shortest Route
-    print(f"\n=============== FINISHED ===============\nShortest Size: {shortest_cost}\nShortest Route: {shortest_route}")
+    report_shortest_route(shortest_route, shortest_cost)
     return shortest_route
 
-## ======================================================================
-## Program Run
-start_time = time.time()
-
-cities_map = get_cities_from_file("../TravellingSalesman/ulysses16(1).csv")
-city_list = get_list_of_cities(cities_map)
-
-population_size = 200
-selection_size = 20
-termination_max_generations = 42
-mutation_probability = 0.5
-recombination_probability = 1 # Must be 100%
+def share_distance_matrix(distance_matrix):
+    shared_memory = SharedMemory(create=True, size=distance_matrix.nbytes)
+    np.ndarray(distance_matrix.shape, distance_matrix.dtype, buffer=shared_memory.buf)[:] = distance_matrix
+    return shared_memory
+
+def init_island_worker(shared_memory_name, shape, dtype):
+    # Each worker process maps the distance matrix from shared memory instead of receiving its own copy,
+    # and runs single threaded, the islands themselves provide the parallelism
+    global island_shared_memory, island_distance_matrix, island_population_evaluator
+    island_shared_memory = SharedMemory(name=shared_memory_name)
+    island_distance_matrix = np.ndarray(shape, dtype, buffer=island_shared_memory.buf)
+    island_population_evaluator = make_population_evaluator(shape[0])
+    set_num_threads(1)
+
+def evolve_island(island):
+    population, population_costs, generations, population_size, selection_size, mutation_probability, recombination_probability = island
+    for _ in range(generations):
+        population, population_costs = evolve_generation(island_distance_matrix, population, population_costs, population_size, selection_size, mutation_probability, recombination_probability, island_population_evaluator)
+    return population, population_costs
+
+def migrate_best_routes(islands):
+    # Ring migration, the best route of each island replaces the worst route of the next island
+    migrants = [(population[0].copy(), population_costs[0]) for population, population_costs in islands]
+    for i, (population, population_costs) in enumerate(islands):
+        population[-1], population_costs[-1] = migrants[i - 1]
+    return islands
+
+def island_evolution(distance_matrix, city_list, island_count, migration_interval, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability, population_evaluator=evaluate_population):
+    # Spread the population over the islands, the first {population size % island count} islands get one extra route
+    if population_size // island_count < 2:
+        raise ValueError(f"Population of {population_size} is too small for {island_count} islands, each island needs at least 2 routes")
+    island_sizes = [population_size // island_count + (i < population_size % island_count) for i in range(island_count)]
+    generation = 0
+
+    # Initialise each island's population randomly
+    islands = []
+    for island_size in island_sizes:
+        population = initialise_population(city_list, island_size)
+        islands.append((population, population_evaluator(population, distance_matrix)))
+    shortest_route, shortest_cost = min((find_shortest_route_in_population(population, population_costs) for population, population_costs in islands), key=lambda best: best[1])
+
+    shared_memory = share_distance_matrix(distance_matrix)
+    try:
+        with get_context("spawn").Pool(island_count, initializer=init_island_worker, initargs=(shared_memory.name, distance_matrix.shape, distance_matrix.dtype)) as pool:
+
+            # Evolve the islands independently, migrating routes between them every {migration interval} generations
+            while generation < termination_max_generations:
+                generations = min(migration_interval, termination_max_generations - generation)
+                islands = pool.map(evolve_island, [(population, population_costs, generations, island_size, selection_size, mutation_probability, recombination_probability)
+                                                   for (population, population_costs), island_size in zip(islands, island_sizes)])
+                generation += generations
+
+                # Evaluate best across all islands before migration
+                new_route, new_cost = min(((population[0], population_costs[0]) for population, population_costs in islands), key=lambda best: best[1])
+                shortest_route, shortest_cost = report_generation(generation, new_route, new_cost, shortest_route, shortest_cost)
+
+                # No migration after the final window, the islands are not evolved again
+                if generation < termination_max_generations:
+                    islands = migrate_best_routes(islands)
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
 
-evolution(cities_map, city_list, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability)
+    # Return Shortest Route
+    report_shortest_route(shortest_route, shortest_cost)
+    return shortest_route
 
-## Program End
-end_time = time.time()
 ## ======================================================================
-print(f"\n\nTime: {end_time-start_time}\n========================================")
\ No newline at end of file
+## Program Run
+if __name__ == "__main__":
+    start_time = time.time()
+
+    cities_map = get_cities_from_file("../TravellingSalesman/ulysses16(1).csv")
+    distance_matrix = get_distance_matrix(cities_map)
+    city_list = get_list_of_cities(cities_map)
+    population_evaluator = make_population_evaluator(len(city_list))
+
+    population_size = 200
+    selection_size = 20
+    termination_max_generations = 42
+    mutation_probability = 0.5
+    recombination_probability = 1 # Must be 100%
+    island_count = 1 # Islands evolve in separate processes when more than 1
+    migration_interval = 7
+
+    if island_count > 1:
+        island_evolution(distance_matrix, city_list, island_count, migration_interval, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability, population_evaluator)
+    else:
+        evolution(distance_matrix, city_list, population_size, selection_size, termination_max_generations, mutation_probability, recombination_probability, population_evaluator)
+
+    ## Program End
+    end_time = time.time()
+    ## ======================================================================
+    print(f"\n\nTime: {end_time-start_time}\n========================================")
\ No newline at end of file